@@ -8,26 +8,27 @@ Usage:
     - Run: python dateregbot_full.py
     - First run: Telethon will ask for phone/code to create session file (dateregbot.session)
 Dependencies:
-    pip install telethon aiogram requests beautifulsoup4 pillow
+    pip install telethon aiogram aiohttp beautifulsoup4 lxml pillow cachetools orjson aiolimiter
 Author: Mars-style professional implementation
 """
 
 import os
 import sys
-import json
 import logging
 import asyncio
+import bisect
+import re
 from io import BytesIO
-from datetime import datetime, timezone
-from typing import Optional, Tuple
+from datetime import date, datetime, timezone
+from typing import Dict, List, Optional, Tuple, Union
 
-import requests
-from bs4 import BeautifulSoup
-from PIL import Image
-from PIL.ExifTags import TAGS
+import aiohttp
+from aiolimiter import AsyncLimiter
+import orjson
+from cachetools import TTLCache
 
 from telethon import TelegramClient
-from telethon.tl.types import User, Message as TLMessage
+from telethon.tl.types import User
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import CommandStart
@@ -48,18 +49,36 @@ TELETHON_API_ID = os.environ.get("TELETHON_API_ID")
 TELETHON_API_HASH = os.environ.get("TELETHON_API_HASH")
 SESSION_NAME = os.environ.get("TELETHON_SESSION", "dateregbot")  # session filename prefix
 
-if not BOT_TOKEN:
-    logger.error("BOT_TOKEN is not set. Exiting.")
-    sys.exit(1)
-if not TELETHON_API_ID or not TELETHON_API_HASH:
-    logger.error("TELETHON_API_ID and TELETHON_API_HASH are required. Exiting.")
-    sys.exit(1)
+def check_config():
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN is not set. Exiting.")
+        sys.exit(1)
+    if not TELETHON_API_ID or not TELETHON_API_HASH:
+        logger.error("TELETHON_API_ID and TELETHON_API_HASH are required. Exiting.")
+        sys.exit(1)
 
 # ------------------------------
 # Anchors (2013-current)
 # ------------------------------
 ANCHORS_FILE = "anchors.json"
 
+# Разобранные якоря держим в памяти и перечитываем раз в сутки:
+# последний якорь — «сейчас», он не должен устаревать
+_ANCHORS_CACHE: Optional[List[Tuple[int, datetime]]] = None
+_ANCHORS_DAY: Optional[date] = None
+_ANCHOR_IDS: List[int] = []
+
+def _parse_iso_utc(s: str) -> Optional[datetime]:
+    try:
+        dt = datetime.fromisoformat(s.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    if dt.utcoffset():
+        return dt.astimezone(timezone.utc)
+    return dt
+
 def ensure_anchors():
     """
     Создаёт anchors.json с автоматически рассчитанными датами с 2013 по текущий год.
@@ -83,35 +102,61 @@ def ensure_anchors():
     # добавляем текущую дату с максимальным user_id
     anchors.append({"id": user_id_end, "ts": now.isoformat()})
 
-    # сохраняем
-    with open(ANCHORS_FILE, "w", encoding="utf-8") as f:
-        json.dump(anchors, f, ensure_ascii=False, indent=2)
+    # сохраняем атомарно: падение посреди записи не оставит битый файл
+    tmp_path = ANCHORS_FILE + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(anchors, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_path, ANCHORS_FILE)
     logger.info("Anchors automatically generated from 2013 to %s", now.date())
 
-def load_anchors():
-    ensure_anchors()
-    with open(ANCHORS_FILE, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    parsed = []
-    for it in data:
-        uid = int(it["id"])
-        ts = datetime.fromisoformat(it["ts"]).astimezone(timezone.utc)
-        parsed.append((uid, ts))
+def _read_anchors() -> List[Tuple[int, datetime]]:
+    if not os.path.exists(ANCHORS_FILE):
+        return []
+    # битый файл не должен ронять старт — вернём [], и load_anchors его перегенерирует
+    try:
+        with open(ANCHORS_FILE, "rb") as f:
+            data = orjson.loads(f.read())
+        parsed = []
+        for it in data:
+            uid = int(it["id"])
+            ts = _parse_iso_utc(it["ts"])
+            if ts is None:
+                continue
+            parsed.append((uid, ts))
+    except (orjson.JSONDecodeError, KeyError, TypeError, ValueError, AttributeError):
+        logger.warning("%s is corrupt, regenerating", ANCHORS_FILE)
+        return []
     parsed.sort(key=lambda x: x[0])
     return parsed
 
+def load_anchors() -> List[Tuple[int, datetime]]:
+    global _ANCHORS_CACHE, _ANCHORS_DAY, _ANCHOR_IDS
+    today = datetime.utcnow().date()
+    if _ANCHORS_CACHE is not None and _ANCHORS_DAY == today:
+        return _ANCHORS_CACHE
+    parsed = _read_anchors()
+    # файла нет или якорь «сейчас» записан не сегодня — перегенерируем
+    if not parsed or parsed[-1][1].date() < today:
+        ensure_anchors()
+        parsed = _read_anchors()
+    _ANCHORS_CACHE = parsed
+    _ANCHOR_IDS = [a[0] for a in parsed]
+    _ANCHORS_DAY = today
+    return parsed
+
 def estimate_by_anchors(user_id: int) -> Tuple[datetime, str]:
     """
     Автоматическая интерполяция даты по anchors (2013-current year).
     """
     anchors = load_anchors()
+    i = bisect.bisect_left(_ANCHOR_IDS, user_id)
+
     # exact match
-    for uid, ts in anchors:
-        if uid == user_id:
-            return ts, "Exact anchor match"
+    if i < len(anchors) and _ANCHOR_IDS[i] == user_id:
+        return anchors[i][1], "Exact anchor match"
 
     # user_id ниже минимального
-    if user_id < anchors[0][0]:
+    if i == 0:
         uid0, t0 = anchors[0]
         uid1, t1 = anchors[1]
         frac = (user_id - uid0) / (uid1 - uid0) if (uid1 - uid0) else 0.0
@@ -119,7 +164,7 @@ def estimate_by_anchors(user_id: int) -> Tuple[datetime, str]:
         return est, "Extrapolated before first anchor (low confidence)"
 
     # user_id выше максимального
-    if user_id > anchors[-1][0]:
+    if i == len(anchors):
         uid0, t0 = anchors[-2]
         uid1, t1 = anchors[-1]
         frac = (user_id - uid1) / (uid1 - uid0) if (uid1 - uid0) else 0.0
@@ -127,14 +172,8 @@ def estimate_by_anchors(user_id: int) -> Tuple[datetime, str]:
         return est, "Extrapolated after last anchor (low confidence)"
 
     # interpolate between two nearest anchors
-    lo, hi = anchors[0], anchors[-1]
-    for i in range(len(anchors) - 1):
-        if anchors[i][0] <= user_id <= anchors[i + 1][0]:
-            lo = anchors[i]
-            hi = anchors[i + 1]
-            break
-    uid_lo, t_lo = lo
-    uid_hi, t_hi = hi
+    uid_lo, t_lo = anchors[i - 1]
+    uid_hi, t_hi = anchors[i]
     frac = (user_id - uid_lo) / (uid_hi - uid_lo) if (uid_hi - uid_lo) else 0.0
     est = t_lo + (t_hi - t_lo) * frac
     return est, f"Interpolated between {uid_lo} and {uid_hi}"
@@ -143,29 +182,32 @@ def estimate_by_anchors(user_id: int) -> Tuple[datetime, str]:
 # DC detection
 # ------------------------------
 def detect_dc_from_id(user_id: int) -> int:
-    try:
-        dc = (user_id >> 28) & 0xF
-        if dc == 0:
-            return 4
-        return dc
-    except Exception:
-        return 4
+    return ((user_id >> 28) & 0xF) or 4
 
 # ------------------------------
 # EXIF extraction helper
 # ------------------------------
+# DateTimeOriginal / DateTimeDigitized лежат в Exif sub-IFD, DateTime — в IFD0
+EXIF_IFD_POINTER = 0x8769
+EXIF_DATETIME_ORIGINAL = 36867
+EXIF_DATETIME_DIGITIZED = 36868
+EXIF_DATETIME = 306
+
 def extract_exif_datetime_from_bytes(image_bytes: bytes) -> Optional[datetime]:
+    from PIL import Image  # тяжёлый импорт — только когда реально нужен
+
     try:
-        img = Image.open(BytesIO(image_bytes))
-        exif = img._getexif()
+        # Image.open читает только заголовок, пиксели не декодируются
+        with Image.open(BytesIO(image_bytes)) as img:
+            exif = img.getexif()
         if not exif:
             return None
-        val = None
-        for k, v in exif.items():
-            name = TAGS.get(k, k)
-            if name in ("DateTimeOriginal", "DateTime", "DateTimeDigitized"):
-                val = v
-                break
+        sub = exif.get_ifd(EXIF_IFD_POINTER)
+        val = (
+            sub.get(EXIF_DATETIME_ORIGINAL)
+            or sub.get(EXIF_DATETIME_DIGITIZED)
+            or exif.get(EXIF_DATETIME)
+        )
         if not val:
             return None
         val = val.replace(":", "-", 2)
@@ -177,87 +219,137 @@ def extract_exif_datetime_from_bytes(image_bytes: bytes) -> Optional[datetime]:
 # ------------------------------
 # t.me scraping (public posts)
 # ------------------------------
-def scrape_earliest_tme_post(username: str) -> Optional[datetime]:
-    try:
-        base = f"https://t.me/{username}"
-        found = []
-        for page in range(1, 6):
-            url = base if page == 1 else f"{base}/{page}"
-            r = requests.get(url, timeout=8)
-            if r.status_code != 200:
-                continue
-            soup = BeautifulSoup(r.text, "html.parser")
-            for t in soup.find_all("time"):
-                dt_attr = t.get("datetime") or t.get("title")
-                if not dt_attr:
-                    continue
-                try:
-                    parsed = datetime.fromisoformat(dt_attr.replace("Z", "+00:00")).astimezone(timezone.utc)
-                    found.append(parsed)
-                except Exception:
-                    continue
-        if not found:
+TME_PAGES = 5
+# t.me стабильно отдаёт <time datetime="...">, дерево для этого строить не нужно
+_TIME_RE = re.compile(rb'<time[^>]+datetime="([^"]+)"')
+
+async def _fetch_tme_page(session: aiohttp.ClientSession, url: str) -> Optional[bytes]:
+    async with session.get(url) as r:
+        if r.status != 200:
             return None
-        return min(found)
-    except Exception:
+        return await r.read()
+
+def _tme_times_regex(body: bytes) -> List[datetime]:
+    found = []
+    for m in _TIME_RE.finditer(body):
+        parsed = _parse_iso_utc(m.group(1).decode("ascii", "ignore"))
+        if parsed:
+            found.append(parsed)
+    return found
+
+def _tme_times_soup(body: bytes) -> List[datetime]:
+    # запасной путь на случай, если разметка t.me поменяется
+    from bs4 import BeautifulSoup, SoupStrainer  # тяжёлый импорт — только когда реально нужен
+
+    found = []
+    # строим дерево только из <time>, остальной документ lxml пропускает
+    soup = BeautifulSoup(body, "lxml", parse_only=SoupStrainer("time"))
+    for t in soup.find_all("time"):
+        dt_attr = t.get("datetime") or t.get("title")
+        if not dt_attr:
+            continue
+        parsed = _parse_iso_utc(dt_attr)
+        if parsed:
+            found.append(parsed)
+    return found
+
+async def scrape_earliest_tme_post_async(session: aiohttp.ClientSession, username: str) -> Optional[datetime]:
+    base = f"https://t.me/{username}"
+    urls = [base if page == 1 else f"{base}/{page}" for page in range(1, TME_PAGES + 1)]
+    # все страницы запрашиваем параллельно: ~1 RTT вместо пяти
+    pages = await asyncio.gather(*(_fetch_tme_page(session, u) for u in urls), return_exceptions=True)
+    found = []
+    for body in pages:
+        if not body or isinstance(body, BaseException):
+            continue
+        times = _tme_times_regex(body)
+        # BeautifulSoup — только если <time> на странице есть, а регэксп их не взял;
+        # разбор синхронный, поэтому уводим его из event loop
+        if not times and b"<time" in body:
+            times = await asyncio.to_thread(_tme_times_soup, body)
+        found.extend(times)
+    if not found:
         return None
+    return min(found)
+
+def create_http_session() -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=8),
+        timeout=aiohttp.ClientTimeout(total=8),
+        headers={"User-Agent": "Mozilla/5.0 (compatible; dateregbot/1.0)"},
+    )
 
 # ------------------------------
 # Telethon helpers (async)
 # ------------------------------
-async def resolve_entity_telethon(client: TelegramClient, identifier: str):
+_NUMERIC_ID_RE = re.compile(r"-?\d+", re.ASCII)
+
+def parse_identifier(identifier: str) -> Union[int, str]:
+    """
+    Убирает @ и приводит числовой id к int; всё остальное остаётся строкой.
+    """
     identifier = identifier.strip()
     if identifier.startswith("@"):
         identifier = identifier[1:]
-    try:
-        ent = await client.get_entity(identifier)
-        return ent
-    except Exception:
-        if identifier.isdigit():
-            try:
-                ent = await client.get_entity(int(identifier))
-                return ent
-            except Exception:
-                pass
-        raise
+    # только ASCII-цифры: "--5" или "²" проходят isdigit(), но ломают int()
+    if _NUMERIC_ID_RE.fullmatch(identifier):
+        return int(identifier)
+    return identifier
+
+async def resolve_entity_telethon(client: TelegramClient, identifier: str):
+    # числовой id сразу передаём как int — без лишнего RPC со строкой
+    return await client.get_entity(parse_identifier(identifier))
+
+PHOTO_DOWNLOAD_CONCURRENCY = 4  # больше — риск FLOOD_WAIT
+
+EXIF_HEAD_BYTES = 64 * 1024  # APP1/EXIF сегмент JPEG лежит в начале файла
+
+async def _photo_exif_datetime(client: TelegramClient, ph) -> Optional[datetime]:
+    # качаем только голову файла — для EXIF весь снимок не нужен
+    # одного чанка размером EXIF_HEAD_BYTES хватает; async with закрывает итератор,
+    # иначе Telethon не вернёт одолженный sender другого DC
+    async with client.iter_download(ph, request_size=EXIF_HEAD_BYTES) as stream:
+        data = await anext(stream, b"")
+    if not data:
+        return None
+    return await asyncio.to_thread(extract_exif_datetime_from_bytes, data)
 
 async def earliest_profile_photo_exif(client: TelegramClient, entity) -> Optional[datetime]:
     try:
         photos = await client.get_profile_photos(entity, limit=20)
-        exif_dates = []
-        for ph in photos:
-            try:
-                b = await client.download_media(ph, file=BytesIO())
-                if isinstance(b, BytesIO):
-                    data = b.getvalue()
-                else:
-                    data = b
-                if not data:
-                    continue
-                exif_dt = extract_exif_datetime_from_bytes(data)
-                if exif_dt:
-                    exif_dates.append(exif_dt)
-            except Exception:
-                continue
-        if exif_dates:
-            return min(exif_dates)
+        # Telethon отдаёт фото от новых к старым; идём с самых старых
+        # небольшими пачками и останавливаемся на первой пачке с EXIF
+        photos = list(reversed(photos))
+        for i in range(0, len(photos), PHOTO_DOWNLOAD_CONCURRENCY):
+            batch = photos[i:i + PHOTO_DOWNLOAD_CONCURRENCY]
+            results = await asyncio.gather(
+                *(_photo_exif_datetime(client, ph) for ph in batch), return_exceptions=True
+            )
+            exif_dates = [r for r in results if isinstance(r, datetime)]
+            if exif_dates:
+                return min(exif_dates)
         return None
     except Exception:
         return None
 
-async def earliest_public_message_date(client: TelegramClient, entity) -> Optional[datetime]:
-    username = getattr(entity, "username", None)
-    if username:
-        scraped = scrape_earliest_tme_post(username)
+async def earliest_public_message_date(
+    client: TelegramClient, entity, scrape_task: Optional["asyncio.Task[Optional[datetime]]"] = None
+) -> Optional[datetime]:
+    # t.me скрейп запускает вызывающий код один раз на запрос — здесь только ждём его
+    if scrape_task is not None:
+        try:
+            scraped = await scrape_task
+        except Exception:
+            scraped = None
         if scraped:
             return scraped
     try:
-        limit = 500
-        async for msg in client.iter_messages(entity, limit=limit, reverse=True):
-            if isinstance(msg, TLMessage) and getattr(msg, "date", None):
-                return msg.date.astimezone(timezone.utc)
+        # одна RPC: самое старое сообщение
+        msgs = await client.get_messages(entity, limit=1, reverse=True)
     except Exception:
         return None
+    if msgs and getattr(msgs[0], "date", None):
+        return msgs[0].date.astimezone(timezone.utc)
     return None
 
 # ------------------------------
@@ -277,42 +369,45 @@ def choose_final_estimate(results: dict) -> Tuple[Optional[datetime], str, float
 # ------------------------------
 # Bot + Telethon runtime
 # ------------------------------
-bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
+bot: Optional[Bot] = None
+
+# Лимит Telegram — 30 сообщений/с на бота; держим запас, чтобы не ловить FLOOD_WAIT
+_reply_limiter = AsyncLimiter(28, 1.0)
+
+FULL_FLAG = "full"
+
 tele_client: Optional[TelegramClient] = None
+http_session: Optional[aiohttp.ClientSession] = None
 
-@dp.message(CommandStart())
-async def cmd_start(msg: types.Message):
-    await msg.reply(
-        "Привет! Это MTProto-backed dateregbot-like service.\n"
-        "Отправь @username, numeric user_id или пересланное сообщение — и я постараюсь определить DC и дату регистрации.\n\n"
-        "🔐 Требуется MTProto-сессия (создаётся автоматически).",
-        parse_mode=ParseMode.HTML
-    )
+# ------------------------------
+# Report building + cache
+# ------------------------------
+DT_FMT = "%Y-%m-%d %H:%M:%S UTC"
 
-@dp.message()
-async def handle_request(msg: types.Message):
-    global tele_client
-    text = (msg.text or "").strip()
-    identifier = None
-    if msg.forward_from and getattr(msg.forward_from, "id", None):
-        identifier = str(msg.forward_from.id)
-    elif msg.forward_from_chat:
-        identifier = getattr(msg.forward_from_chat, "username", None) or str(getattr(msg.forward_from_chat, "id", None))
-    elif text:
-        identifier = text.split()[0]
-    else:
-        await msg.reply("Пожалуйста, пришлите @username или numeric user_id или пересланное сообщение.")
-        return
+def _fmt_dt(dt: Optional[datetime]) -> Optional[str]:
+    return dt.strftime(DT_FMT) if dt else None
+
+class ResolveError(Exception):
+    pass
 
-    await msg.reply("🔎 Иду собирать данные... это может занять несколько секунд (обычно <10s).")
+# Повторные запросы одного и того же идентификатора отдаём из кэша
+_REPORT_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=600)
+# Идущие вычисления: параллельные запросы того же ключа ждут одну задачу
+_REPORT_INFLIGHT: Dict[Tuple[Union[int, str], bool], "asyncio.Task[str]"] = {}
 
+def _report_cache_key(identifier: str, full: bool) -> Tuple[Union[int, str], bool]:
+    ident = parse_identifier(identifier)
+    if isinstance(ident, str):
+        ident = ident.lower()
+    return ident, full
+
+async def build_report(identifier: str, full: bool) -> str:
     try:
         ent = await resolve_entity_telethon(tele_client, identifier)
     except Exception as e:
-        await msg.reply(f"❌ Не удалось разрешить идентификатор: {identifier}\nОшибка: {e}")
-        return
+        raise ResolveError(str(e)) from e
 
     results = {}
     user_id = None
@@ -325,52 +420,134 @@ async def handle_request(msg: types.Message):
 
     dc = detect_dc_from_id(user_id)
 
-    pf_dt = await earliest_profile_photo_exif(tele_client, ent)
+    # источники независимы — запускаем одновременно, ждём максимум, а не сумму
+    pf_task = asyncio.create_task(earliest_profile_photo_exif(tele_client, ent))
+    tme_task = asyncio.create_task(scrape_earliest_tme_post_async(http_session, uname)) if uname else None
+    tm_task = asyncio.create_task(earliest_public_message_date(tele_client, ent, tme_task))
+
+    pf_dt = await pf_task
     if pf_dt:
         results["by_profile_photo"] = pf_dt
 
-    tm_dt = await earliest_public_message_date(tele_client, ent)
-    if tm_dt:
-        results["by_telethon_msg"] = tm_dt
-
-    if uname and "by_tme_scrape" not in results:
-        scraped = scrape_earliest_tme_post(uname)
-        if scraped:
-            results["by_tme_scrape"] = scraped
+    others = [(k, t) for k, t in (("by_telethon_msg", tm_task), ("by_tme_scrape", tme_task)) if t is not None]
+    # EXIF профиля — сигнал высокой уверенности: choose_final_estimate выберет его в любом случае.
+    # Отменяем только ещё идущие задачи — уже готовые результаты оплачены, их оставляем
+    if pf_dt and not full:
+        for _, t in others:
+            if not t.done():
+                t.cancel()
+    # ждём и отменённые задачи, чтобы их исключения не терялись
+    values = await asyncio.gather(*(t for _, t in others), return_exceptions=True)
+    for (key, _), value in zip(others, values):
+        if isinstance(value, datetime):
+            results[key] = value
 
     anchors_dt, _ = estimate_by_anchors(user_id)
     results["by_anchors"] = anchors_dt
 
     final_dt, explanation_text, confidence = choose_final_estimate(results)
 
-    lines = []
-    lines.append(f"🔍 Результат проверки для <b>{name}</b> {('<code>@'+uname+'</code>') if uname else ''}")
-    lines.append(f"ID: <code>{user_id}</code>")
-    lines.append(f"DC (detected): <b>{dc}</b>\n")
-    if results.get("by_profile_photo"):
-        lines.append(f"• Profile photo EXIF: <b>{results['by_profile_photo'].strftime('%Y-%m-%d %H:%M:%S UTC')}</b> (high)")
-    if results.get("by_telethon_msg"):
-        lines.append(f"• Earliest message (telethon scan): <b>{results['by_telethon_msg'].strftime('%Y-%m-%d %H:%M:%S UTC')}</b> (medium-high)")
-    if results.get("by_tme_scrape"):
-        lines.append(f"• Earliest public t.me post: <b>{results['by_tme_scrape'].strftime('%Y-%m-%d %H:%M:%S UTC')}</b> (medium)")
-    if results.get("by_anchors"):
-        lines.append(f"• Anchors estimate: <b>{results['by_anchors'].strftime('%Y-%m-%d %H:%M:%S UTC')}</b> (low)")
-    lines.append("")
+    pf_s = _fmt_dt(results.get("by_profile_photo"))
+    tm_s = _fmt_dt(results.get("by_telethon_msg"))
+    tme_s = _fmt_dt(results.get("by_tme_scrape"))
+    an_s = _fmt_dt(results.get("by_anchors"))
+
+    lines = (
+        f"🔍 Результат проверки для <b>{name}</b> {('<code>@'+uname+'</code>') if uname else ''}",
+        f"ID: <code>{user_id}</code>",
+        f"DC (detected): <b>{dc}</b>\n",
+        f"• Profile photo EXIF: <b>{pf_s}</b> (high)" if pf_s else None,
+        f"• Earliest message (telethon scan): <b>{tm_s}</b> (medium-high)" if tm_s else None,
+        f"• Earliest public t.me post: <b>{tme_s}</b> (medium)" if tme_s else None,
+        f"• Anchors estimate: <b>{an_s}</b> (low)" if an_s else None,
+        "",
+    )
     if final_dt:
-        lines.append(f"✅ <b>Final estimate:</b> <code>{final_dt.strftime('%Y-%m-%d %H:%M:%S UTC')}</code>")
-        lines.append(f"ℹ️ Reason: {explanation_text}")
-        lines.append(f"🔒 Confidence: {int(confidence*100)}%")
+        tail = (
+            f"✅ <b>Final estimate:</b> <code>{_fmt_dt(final_dt)}</code>\n"
+            f"ℹ️ Reason: {explanation_text}\n"
+            f"🔒 Confidence: {int(confidence*100)}%"
+        )
     else:
-        lines.append("⚠️ Не удалось получить достаточных данных для оценки.")
+        tail = "⚠️ Не удалось получить достаточных данных для оценки."
+    return "\n".join(line for line in lines if line is not None) + "\n" + tail
+
+async def get_report(key: Tuple[Union[int, str], bool], identifier: str, full: bool) -> str:
+    task = _REPORT_INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.create_task(build_report(identifier, full))
+        _REPORT_INFLIGHT[key] = task
+        task.add_done_callback(lambda _: _REPORT_INFLIGHT.pop(key, None))
+    # shield: отмена одного ожидающего не должна отменять общую задачу
+    reply_text = await asyncio.shield(task)
+    _REPORT_CACHE[key] = reply_text
+    return reply_text
+
+# ------------------------------
+# Handlers
+# ------------------------------
+async def reply_limited(msg: types.Message, text: str, **kwargs) -> types.Message:
+    async with _reply_limiter:
+        return await msg.reply(text, **kwargs)
+
+async def edit_limited(msg: types.Message, text: str, **kwargs):
+    async with _reply_limiter:
+        return await msg.edit_text(text, **kwargs)
+
+@dp.message(CommandStart())
+async def cmd_start(msg: types.Message):
+    await reply_limited(
+        msg,
+        "Привет! Это MTProto-backed dateregbot-like service.\n"
+        "Отправь @username, numeric user_id или пересланное сообщение — и я постараюсь определить DC и дату регистрации.\n"
+        "Добавь <code>full</code> после идентификатора, чтобы получить все источники.\n\n"
+        "🔐 Требуется MTProto-сессия (создаётся автоматически).",
+        parse_mode=ParseMode.HTML
+    )
+
+@dp.message()
+async def handle_request(msg: types.Message):
+    text = (msg.text or "").strip()
+    identifier = None
+    full = False
+    if msg.forward_from and getattr(msg.forward_from, "id", None):
+        identifier = str(msg.forward_from.id)
+    elif msg.forward_from_chat:
+        identifier = getattr(msg.forward_from_chat, "username", None) or str(getattr(msg.forward_from_chat, "id", None))
+    elif text:
+        words = text.split()
+        identifier = words[0]
+        # "full" после идентификатора — собрать все источники, даже если EXIF уже найден;
+        # у пересланных сообщений текст чужой, флаг из него не берём
+        full = FULL_FLAG in (w.lower() for w in words[1:])
+    else:
+        await reply_limited(msg, "Пожалуйста, пришлите @username или numeric user_id или пересланное сообщение.")
+        return
+
+    key = _report_cache_key(identifier, full)
+    reply_text = _REPORT_CACHE.get(key)
+    if reply_text is not None:
+        await reply_limited(msg, reply_text, parse_mode=ParseMode.HTML)
+        return
+
+    # одно исходящее сообщение на запрос: статус потом редактируем результатом
+    status = await reply_limited(msg, "🔎 Иду собирать данные... это может занять несколько секунд (обычно <10s).")
+    try:
+        reply_text = await get_report(key, identifier, full)
+    except ResolveError as e:
+        await edit_limited(status, f"❌ Не удалось разрешить идентификатор: {identifier}\nОшибка: {e}")
+        return
 
-    reply_text = "\n".join(lines)
-    await msg.reply(reply_text, parse_mode=ParseMode.HTML)
+    await edit_limited(status, reply_text, parse_mode=ParseMode.HTML)
 
 # ------------------------------
 # Startup
 # ------------------------------
 async def start_services():
-    global tele_client
+    global bot, tele_client, http_session
+    load_anchors()
+    bot = Bot(token=BOT_TOKEN)
+    http_session = create_http_session()
     tele_client = TelegramClient(SESSION_NAME, int(TELETHON_API_ID), TELETHON_API_HASH)
     await tele_client.connect()
     if not await tele_client.is_user_authorized():
@@ -388,8 +565,11 @@ async def main():
                 await tele_client.disconnect()
         except Exception:
             pass
+        if http_session and not http_session.closed:
+            await http_session.close()
 
 if __name__ == "__main__":
+    check_config()
     try:
         asyncio.run(main())
     except KeyboardInterrupt: